@@ -20,10 +20,15 @@ import hashlib
 import uuid
 import json
 import logging
+import logging.handlers
+import sys
 from datetime import datetime, date, time, timedelta
 from decimal import Decimal
-from typing import Dict, List, Tuple, Optional
-from collections import defaultdict
+from typing import Callable, Dict, List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+# Let the ODBC driver manager reuse physical connections
+pyodbc.pooling = True
 
 # ============================================================================
 # Configuration
@@ -33,10 +38,17 @@ SECRET_KEY = ""
 BASE_URL = "https://eai.nazeel.net/api/odoo-TransactionsTransfer"
 CONNECTION_STRING = "DRIVER={SQL Server};SERVER=SERVER_NAME;DATABASE=DB_NAME;Trusted_Connection=yes;"
 LOG_FILE = r"C:\Scripts\P03139\nazeel_log.txt"
+DEFAULT_LOOKBACK_DAYS = 120
+
+# API endpoints
+INVOICES_ENDPOINT = "Getinvoices"
+RECEIPTS_ENDPOINT = "GetReciptVouchers"
+REFUNDS_ENDPOINT = "GetRefundVouchers"
 
 # Table names
 HED_TABLE = "FhglTxHed"
 DED_TABLE = "FhglTxDed"
+TRACKING_TABLES = ("Processed_Invoices", "Processed_Receipts", "Processed_Refunds", "Staff_Account_Entries")
 
 # Account codes
 REVENUE_ACCOUNT = "101000020"
@@ -47,9 +59,18 @@ GUEST_LEDGER_ACCOUNT = "011200010"
 CASH_OVER_SHORT_ACCOUNT = "505000098"
 STAFF_ACCOUNT = "011500070"
 
-# Payment matching thresholds
-EXACT_MATCH_TOLERANCE = 0.01  # SAR
-UNDERPAYMENT_TOLERANCE = 10.00  # SAR
+# Payment matching thresholds (in halalas, 100 halalas = 1 SAR)
+EXACT_MATCH_TOLERANCE = 1  # 0.01 SAR
+UNDERPAYMENT_TOLERANCE = 1000  # 10.00 SAR
+
+# Processed-key lookups start this many days before the earliest fetched revenue date.
+# Earlier versions assigned RevenueDate with a 12PM cutoff, up to a day before the
+# calendar date used now, so stored dates can trail the recomputed ones (+1 day headroom)
+PROCESSED_LOOKUP_MARGIN_DAYS = 2
+
+# Commit batching - pending revenue dates are committed once either limit is reached
+COMMIT_BATCH_DATES = 16
+COMMIT_BATCH_ROWS = 2000  # receipts + refunds + invoices
 
 # Payment method mapping
 PAYMENT_METHOD_ACCOUNTS = {
@@ -65,6 +86,18 @@ PAYMENT_METHOD_ACCOUNTS = {
     10: ("011200065", "GCCNET")
 }
 
+# Same mapping as a flat table indexed by payment method id (None = unmapped)
+PAYMENT_METHOD_ACCOUNTS_TBL = tuple(
+    PAYMENT_METHOD_ACCOUNTS.get(i) for i in range(max(PAYMENT_METHOD_ACCOUNTS) + 1)
+)
+
+# Invoice line itemType -> revenue component ('Fee--' lines are always municipality tax)
+_COMPONENT_BY_TYPE = {
+    1: 'individual_rate',
+    3: 'penalties',
+    4: 'municipality_tax',
+}
+
 # ============================================================================
 # SQL Table Creation Scripts
 # ============================================================================
@@ -93,21 +126,6 @@ AND EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Process
 BEGIN
     EXEC sp_rename 'Processed_Invoices.InvoiceDate', 'RevenueDate', 'COLUMN'
 END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Invoices' AND COLUMN_NAME = 'ComsysYear')
-BEGIN
-    ALTER TABLE Processed_Invoices ADD ComsysYear VARCHAR(4) NULL
-END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Invoices' AND COLUMN_NAME = 'ComsysMonth')
-BEGIN
-    ALTER TABLE Processed_Invoices ADD ComsysMonth VARCHAR(2) NULL
-END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Invoices' AND COLUMN_NAME = 'ComsysSerial')
-BEGIN
-    ALTER TABLE Processed_Invoices ADD ComsysSerial INT NULL
-END
 """
 
 CREATE_PROCESSED_RECEIPTS_TABLE = """
@@ -129,21 +147,6 @@ BEGIN
         UNIQUE(VoucherNumber)
     )
 END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Receipts' AND COLUMN_NAME = 'ComsysYear')
-BEGIN
-    ALTER TABLE Processed_Receipts ADD ComsysYear VARCHAR(4) NULL
-END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Receipts' AND COLUMN_NAME = 'ComsysMonth')
-BEGIN
-    ALTER TABLE Processed_Receipts ADD ComsysMonth VARCHAR(2) NULL
-END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Receipts' AND COLUMN_NAME = 'ComsysSerial')
-BEGIN
-    ALTER TABLE Processed_Receipts ADD ComsysSerial INT NULL
-END
 """
 
 CREATE_PROCESSED_REFUNDS_TABLE = """
@@ -165,21 +168,6 @@ BEGIN
         UNIQUE(VoucherNumber)
     )
 END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Refunds' AND COLUMN_NAME = 'ComsysYear')
-BEGIN
-    ALTER TABLE Processed_Refunds ADD ComsysYear VARCHAR(4) NULL
-END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Refunds' AND COLUMN_NAME = 'ComsysMonth')
-BEGIN
-    ALTER TABLE Processed_Refunds ADD ComsysMonth VARCHAR(2) NULL
-END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Processed_Refunds' AND COLUMN_NAME = 'ComsysSerial')
-BEGIN
-    ALTER TABLE Processed_Refunds ADD ComsysSerial INT NULL
-END
 """
 
 CREATE_STAFF_ACCOUNT_TABLE = """
@@ -209,36 +197,222 @@ BEGIN
         UNIQUE(InvoiceNumber)
     )
 END
+"""
 
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Staff_Account_Entries' AND COLUMN_NAME = 'Status')
+# Columns added after the tables were first deployed - (table, column, definition)
+TRACKING_TABLE_COLUMNS = [
+    ("Processed_Invoices", "ComsysYear", "VARCHAR(4) NULL"),
+    ("Processed_Invoices", "ComsysMonth", "VARCHAR(2) NULL"),
+    ("Processed_Invoices", "ComsysSerial", "INT NULL"),
+    ("Processed_Receipts", "ComsysYear", "VARCHAR(4) NULL"),
+    ("Processed_Receipts", "ComsysMonth", "VARCHAR(2) NULL"),
+    ("Processed_Receipts", "ComsysSerial", "INT NULL"),
+    ("Processed_Refunds", "ComsysYear", "VARCHAR(4) NULL"),
+    ("Processed_Refunds", "ComsysMonth", "VARCHAR(2) NULL"),
+    ("Processed_Refunds", "ComsysSerial", "INT NULL"),
+    ("Staff_Account_Entries", "Status", "NVARCHAR(20) NOT NULL DEFAULT 'PENDING'"),
+    ("Staff_Account_Entries", "CollectionVoucherNumber", "NVARCHAR(50) NULL"),
+]
+
+# One batch per index so a failure on one does not skip the rest
+CREATE_TRACKING_INDEXES = (
+    """
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_ProcInv_RevDate_InvNo' AND object_id = OBJECT_ID('Processed_Invoices'))
 BEGIN
-    ALTER TABLE Staff_Account_Entries ADD Status NVARCHAR(20) NOT NULL DEFAULT 'PENDING'
+    CREATE NONCLUSTERED INDEX IX_ProcInv_RevDate_InvNo ON Processed_Invoices (RevenueDate, InvoiceNumber)
+    INCLUDE (Docu, ComsysYear, ComsysMonth, ComsysSerial)
 END
-
-IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'Staff_Account_Entries' AND COLUMN_NAME = 'CollectionVoucherNumber')
+""",
+    """
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_ProcRec_RevDate_VchNo' AND object_id = OBJECT_ID('Processed_Receipts'))
 BEGIN
-    ALTER TABLE Staff_Account_Entries ADD CollectionVoucherNumber NVARCHAR(50) NULL
+    CREATE NONCLUSTERED INDEX IX_ProcRec_RevDate_VchNo ON Processed_Receipts (RevenueDate, VoucherNumber)
+    INCLUDE (Docu, ComsysYear, ComsysMonth, ComsysSerial)
 END
+""",
+    """
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_ProcRef_RevDate_VchNo' AND object_id = OBJECT_ID('Processed_Refunds'))
+BEGIN
+    CREATE NONCLUSTERED INDEX IX_ProcRef_RevDate_VchNo ON Processed_Refunds (RevenueDate, VoucherNumber)
+    INCLUDE (Docu, ComsysYear, ComsysMonth, ComsysSerial)
+END
+""",
+    """
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_StaffAcc_Status_RevDate' AND object_id = OBJECT_ID('Staff_Account_Entries'))
+BEGIN
+    CREATE NONCLUSTERED INDEX IX_StaffAcc_Status_RevDate ON Staff_Account_Entries (Status, RevenueDate)
+    INCLUDE (InvoiceNumber, ReservationNumber, ShortageAmount)
+END
+""",
+)
+
+# ============================================================================
+# SQL Statements
+# ============================================================================
+
+VALIDATE_JOURNAL_SQL = "SELECT COUNT(*) FROM dbo.FGnrJour WHERE Journal = ?"
+
+COUNT_TRACKING_TABLES_SQL = (
+    f"SELECT COUNT(*) FROM sys.tables WHERE name IN ({', '.join('?' * len(TRACKING_TABLES))})"
+)
+
+SELECT_PROCESSED_INVOICES_SQL = "SELECT InvoiceNumber FROM Processed_Invoices"
+SELECT_PROCESSED_RECEIPTS_SQL = "SELECT VoucherNumber FROM Processed_Receipts"
+SELECT_PROCESSED_REFUNDS_SQL = "SELECT VoucherNumber FROM Processed_Refunds"
+PROCESSED_SINCE_FILTER = " WHERE RevenueDate >= ?"
+
+# Allocates the next serial and inserts the header in one round trip. The range
+# lock stops two runs from taking the same serial; OUTPUT goes INTO a table
+# variable because a plain OUTPUT clause is rejected on tables with triggers.
+INSERT_HED_SQL = f"""
+SET NOCOUNT ON;
+DECLARE @Inserted TABLE (Serial INT);
+INSERT INTO {HED_TABLE} (Docu, Year, Month, Serial, Date, Currency, Rate, Posted, ReEvaluate, RepeatedSerial, Flag)
+OUTPUT inserted.Serial INTO @Inserted
+SELECT ?, ?, ?, ISNULL(MAX(Serial), 0) + 1, ?, '001', 1.0, 0, 0, NULL, NULL
+FROM {HED_TABLE} WITH (UPDLOCK, HOLDLOCK)
+WHERE Docu = ? AND Year = ? AND Month = ?;
+SELECT Serial FROM @Inserted;
 """
 
-# Setup logging
+INSERT_DED_SQL = f"""
+INSERT INTO {DED_TABLE} (Docu, Year, Month, Serial, Line, Account, ValuLeDr, ValuLeCr, ValuFcDr, ValuFcCr, [Desc])
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_PROCESSED_RECEIPT_SQL = """
+INSERT INTO Processed_Receipts
+(VoucherNumber, ReservationNumber, Amount, PaymentMethodId, IssueDateTime, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
+SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+WHERE NOT EXISTS (SELECT 1 FROM Processed_Receipts WHERE VoucherNumber = ?)
+"""
+
+INSERT_PROCESSED_REFUND_SQL = """
+INSERT INTO Processed_Refunds
+(VoucherNumber, ReservationNumber, Amount, PaymentMethodId, IssueDateTime, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
+SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+WHERE NOT EXISTS (SELECT 1 FROM Processed_Refunds WHERE VoucherNumber = ?)
+"""
+
+INSERT_PROCESSED_INVOICE_SQL = """
+INSERT INTO Processed_Invoices
+(InvoiceNumber, ReservationNumber, TotalAmount, RevenueDate, RawInvoiceDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
+SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+WHERE NOT EXISTS (SELECT 1 FROM Processed_Invoices WHERE InvoiceNumber = ?)
+"""
+
+INSERT_STAFF_ACCOUNT_ENTRY_SQL = """
+INSERT INTO Staff_Account_Entries
+(InvoiceNumber, ReservationNumber, GuestName, InvoiceAmount, ReceivedAmount,
+ ShortageAmount, ShortageType, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial, Status, Notes)
+SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'PENDING', ?
+WHERE NOT EXISTS (SELECT 1 FROM Staff_Account_Entries WHERE InvoiceNumber = ?)
+"""
+
+# Parameter types for the tracking inserts, matching the column definitions above,
+# so fast_executemany binds fixed-width buffers instead of sizing from the first row
+_KEY_PARAM = (pyodbc.SQL_WVARCHAR, 50, 0)
+_AMOUNT_PARAM = (pyodbc.SQL_DECIMAL, 18, 2)
+_DATETIME_PARAM = (pyodbc.SQL_TYPE_TIMESTAMP, 23, 3)
+_DATE_PARAM = (pyodbc.SQL_TYPE_DATE, 10, 0)
+_INT_PARAM = (pyodbc.SQL_INTEGER, 0, 0)
+_COMSYS_REF_PARAMS = [(pyodbc.SQL_VARCHAR, 5, 0), (pyodbc.SQL_VARCHAR, 4, 0), (pyodbc.SQL_VARCHAR, 2, 0), _INT_PARAM]
+
+PROCESSED_VOUCHER_INPUT_SIZES = [
+    _KEY_PARAM, _KEY_PARAM, _AMOUNT_PARAM, _INT_PARAM, _DATETIME_PARAM, _DATE_PARAM,
+    *_COMSYS_REF_PARAMS, _KEY_PARAM
+]
+PROCESSED_INVOICE_INPUT_SIZES = [
+    _KEY_PARAM, _KEY_PARAM, _AMOUNT_PARAM, _DATE_PARAM, _DATETIME_PARAM,
+    *_COMSYS_REF_PARAMS, _KEY_PARAM
+]
+STAFF_ACCOUNT_ENTRY_INPUT_SIZES = [
+    _KEY_PARAM, _KEY_PARAM, (pyodbc.SQL_WVARCHAR, 200, 0), _AMOUNT_PARAM, _AMOUNT_PARAM, _AMOUNT_PARAM,
+    (pyodbc.SQL_WVARCHAR, 20, 0), _DATE_PARAM, *_COMSYS_REF_PARAMS, (pyodbc.SQL_WVARCHAR, 500, 0), _KEY_PARAM
+]
+
+# Setup logging - file writes are buffered and flushed every 1024 records,
+# on any ERROR, and at interpreter exit
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+_BANNER = '=' * 80
+_file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
+_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
+        logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=_file_handler),
         logging.StreamHandler()
     ]
 )
 
 
+# ============================================================================
+# Helpers
+# ============================================================================
+
+def _payment_method_account(method_id) -> Optional[Tuple[str, str]]:
+    """Get (account, description) for a payment method id, None if unmapped"""
+    if isinstance(method_id, int) and 0 <= method_id < len(PAYMENT_METHOD_ACCOUNTS_TBL):
+        return PAYMENT_METHOD_ACCOUNTS_TBL[method_id]
+    return None
+
+
+# MD5 state after hashing SECRET_KEY; each auth key only has to add the date.
+# The digest is an API signature, not a security control, so it is flagged as
+# such for OpenSSL builds that restrict MD5.
+_SECRET_KEY_HASH = hashlib.md5(SECRET_KEY.encode(), usedforsecurity=False)
+
+
+def _parse_api_datetime(value: str) -> datetime:
+    """Parse an API ISO timestamp as a naive datetime, dropping a trailing 'Z'"""
+    return datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+
+
+def _processed_lookup_start(items: List[Dict], timestamp_key: str) -> Optional[date]:
+    """RevenueDate to load processed keys from, or None (no bound) if any item lacks its own timestamp"""
+    # Items without a usable timestamp fall back to today's date, so an earlier
+    # run may have tracked them under a different, older RevenueDate
+    if not items or any(timestamp_key not in item for item in items):
+        return None
+    return min(item['_revenue_date'] for item in items) - timedelta(days=PROCESSED_LOOKUP_MARGIN_DAYS)
+
+
+def _to_cents(amount) -> int:
+    """Convert an API amount in SAR to integer halalas"""
+    return int(round(float(amount or 0) * 100))
+
+
+def _to_decimal(amount) -> Decimal:
+    """Convert an API amount in SAR to a 2-place Decimal for DECIMAL column binding"""
+    return Decimal(_to_cents(amount)).scaleb(-2)
+
+
+def _executemany_sized(cursor, sql: str, rows: List[Tuple], input_sizes: List[Tuple]) -> None:
+    """executemany with explicit parameter types, cleared afterwards since the cursor is shared"""
+    cursor.setinputsizes(input_sizes)
+    try:
+        cursor.executemany(sql, rows)
+    finally:
+        cursor.setinputsizes(None)
+
+
+def _sum_by_payment_method(items: List[Dict]) -> Dict[int, float]:
+    """Total the pre-computed halala amounts of receipts/refunds per payment method, in SAR"""
+    totals = {}
+    for item in items:
+        method_id = item.get('paymentMethodId')
+        totals[method_id] = totals.get(method_id, 0) + item['_amount_cents']
+    return {method_id: cents / 100 for method_id, cents in totals.items()}
+
+
 # ============================================================================
 # Main Integration Class
 # ============================================================================
 
 class NazeelComsysIntegrator:
-    def __init__(self, start_date=None, end_date=None):
-        """Initialize integrator with date range"""
+    def __init__(self, start_date=None, end_date=None, init_schema=False):
+        """Initialize integrator with date range, creating or upgrading tracking tables if any are missing"""
         if start_date and end_date:
             self.start_date = start_date
             self.end_date = end_date
@@ -248,121 +422,210 @@ class NazeelComsysIntegrator:
             now = datetime.now()
             self.current_run_time = now.replace(hour=12, minute=0, second=0, microsecond=0)
             self.end_date = self.current_run_time
-            self.start_date = self.current_run_time - timedelta(days=120)
+            self.start_date = self.current_run_time - timedelta(days=DEFAULT_LOOKBACK_DAYS)
             self.api_fetch_start = self.start_date
             self.api_fetch_end = self.end_date
 
         self.current_date = date.today()
         self.auth_key = self._generate_auth_key()
-        self._ensure_tracking_tables()
+        self._conn = None
+
+        # Processed key sets, loaded on first use and kept current as dates are committed,
+        # with the RevenueDate lower bound each was loaded with (None = whole table)
+        self._processed_invoices = None
+        self._processed_receipts = None
+        self._processed_refunds = None
+        self._processed_since = {}
+
+        # Docu -> FGnrJour lookup result, so each journal is only validated once per run
+        self._journal_valid = {}
+
+        # Revenue dates that must not be posted this run because a record on them, or a
+        # voucher of one of their invoices' reservations, has a non-numeric amount
+        self._unpostable_dates = set()
+        self._unpostable_reservations = set()
+
+        # One HTTP session for all API calls so concurrent fetches reuse pooled connections
+        self._session = requests.Session()
+        self._session.headers.update({
+            "Content-Type": "application/json",
+            "authKey": self.auth_key
+        })
+        # A missing table means an older schema, so existing tables get the column upgrade too
+        if init_schema or not self._tracking_tables_exist():
+            self._ensure_tracking_tables(strict=init_schema)
+
+    def _get_conn(self):
+        """Get the integrator's shared database connection, opening it on first use"""
+        if self._conn is None:
+            self._conn = pyodbc.connect(CONNECTION_STRING, autocommit=False)
+        return self._conn
+
+    def close(self) -> None:
+        """Close the HTTP session and the shared database connection"""
+        self._session.close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def _generate_auth_key(self) -> str:
         """Generate MD5 hash for authKey"""
-        date_str = self.current_date.strftime("%d/%m/%Y")
-        combined = f"{SECRET_KEY}{date_str}"
-        return hashlib.md5(combined.encode()).hexdigest()
+        auth_hash = _SECRET_KEY_HASH.copy()
+        auth_hash.update(self.current_date.strftime("%d/%m/%Y").encode())
+        return auth_hash.hexdigest()
 
-    def _ensure_tracking_tables(self):
-        """Ensure tracking tables exist and have all required columns"""
+    def _ensure_tracking_tables(self, strict: bool = False):
+        """Ensure tracking tables exist and have all required columns and indexes; strict re-raises DDL failures"""
         try:
-            with pyodbc.connect(CONNECTION_STRING) as conn:
-                cursor = conn.cursor()
-
-                for statement in CREATE_PROCESSED_INVOICES_TABLE.split('\nGO\n'):
-                    if statement.strip():
-                        try:
-                            cursor.execute(statement)
-                            conn.commit()
-                        except Exception as e:
-                            logging.debug(f"Statement execution note: {str(e)}")
-
-                for statement in CREATE_PROCESSED_RECEIPTS_TABLE.split('\nGO\n'):
-                    if statement.strip():
-                        try:
-                            cursor.execute(statement)
-                            conn.commit()
-                        except Exception as e:
-                            logging.debug(f"Statement execution note: {str(e)}")
+            conn = self._get_conn()
+            cursor = conn.cursor()
 
-                for statement in CREATE_PROCESSED_REFUNDS_TABLE.split('\nGO\n'):
-                    if statement.strip():
-                        try:
-                            cursor.execute(statement)
-                            conn.commit()
-                        except Exception as e:
-                            logging.debug(f"Statement execution note: {str(e)}")
+            ok = True
+            for script in (CREATE_PROCESSED_INVOICES_TABLE, CREATE_PROCESSED_RECEIPTS_TABLE,
+                           CREATE_PROCESSED_REFUNDS_TABLE, CREATE_STAFF_ACCOUNT_TABLE):
+                ok = self._execute_ddl_script(conn, cursor, script, strict) and ok
 
-                for statement in CREATE_STAFF_ACCOUNT_TABLE.split('\nGO\n'):
-                    if statement.strip():
-                        try:
-                            cursor.execute(statement)
-                            conn.commit()
-                        except Exception as e:
-                            logging.debug(f"Statement execution note: {str(e)}")
+            self._add_missing_columns(conn, cursor)
+            for script in CREATE_TRACKING_INDEXES:
+                ok = self._execute_ddl_script(conn, cursor, script, strict) and ok
 
+            if ok:
                 logging.info("✓ Tracking tables verified/created successfully")
+            else:
+                logging.warning("Tracking tables verified with DDL failures (see warnings above)")
 
         except Exception as e:
             logging.error(f"Failed to ensure tracking tables: {str(e)}")
             raise
 
-    def _validate_journal(self, conn, docu: str) -> bool:
+    def _tracking_tables_exist(self) -> bool:
+        """Check in one round trip that every tracking table is present"""
+        cursor = self._get_conn().cursor()
+        cursor.execute(COUNT_TRACKING_TABLES_SQL, TRACKING_TABLES)
+        return cursor.fetchone()[0] == len(TRACKING_TABLES)
+
+    def _execute_ddl_script(self, conn, cursor, script: str, strict: bool = False) -> bool:
+        """Execute an IF NOT EXISTS-guarded DDL script as one batch and commit it; False if it failed"""
+        try:
+            cursor.execute(script)
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            logging.warning(f"DDL script failed: {str(e)}")
+            if strict:
+                raise
+            return False
+
+    def _add_missing_columns(self, conn, cursor) -> None:
+        """Add any TRACKING_TABLE_COLUMNS entries missing from the database"""
+        tables = sorted({table for table, _, _ in TRACKING_TABLE_COLUMNS})
+        cursor.execute(
+            f"SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            f"WHERE TABLE_NAME IN ({', '.join('?' * len(tables))})",
+            tables
+        )
+        existing = {(row[0], row[1]) for row in cursor.fetchall()}
+
+        missing = [(table, column, definition) for table, column, definition in TRACKING_TABLE_COLUMNS
+                   if (table, column) not in existing]
+        if not missing:
+            return
+
+        for table, column, definition in missing:
+            cursor.execute(f"ALTER TABLE {table} ADD {column} {definition}")
+        conn.commit()
+
+        for table, column, _ in missing:
+            logging.info(f"Added column {table}.{column}")
+
+    def _validate_journal(self, cursor, docu: str) -> bool:
         """Validate that the Docu value exists in FGnrJour table"""
+        if docu in self._journal_valid:
+            return self._journal_valid[docu]
+
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM dbo.FGnrJour WHERE Journal = ?", (docu,))
+            cursor.execute(VALIDATE_JOURNAL_SQL, (docu,))
             count = cursor.fetchone()[0]
-            return count > 0
+            self._journal_valid[docu] = count > 0
+            return self._journal_valid[docu]
         except Exception as e:
             logging.error(f"Failed to validate Docu {docu}: {str(e)}")
             return False
 
-    def get_processed_invoices(self) -> set:
-        """Get set of already processed invoice numbers"""
+    def _processed_covers(self, kind: str, since: Optional[date]) -> bool:
+        """Whether the cached processed set for kind was loaded with a bound at or below since"""
+        loaded_since = self._processed_since[kind]
+        return loaded_since is None or (since is not None and loaded_since <= since)
+
+    def _query_processed_keys(self, sql: str, since: Optional[date]) -> set:
+        """Run a processed-key SELECT, limited to RevenueDate >= since when a bound is given"""
+        cursor = self._get_conn().cursor()
+        if since is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql + PROCESSED_SINCE_FILTER, (since,))
+        return {row[0] for row in cursor.fetchall()}
+
+    def get_processed_invoices(self, since: Optional[date]) -> set:
+        """Get set of already processed invoice numbers with RevenueDate >= since (all if None)"""
+        if self._processed_invoices is not None and self._processed_covers('invoices', since):
+            return self._processed_invoices
+
         try:
-            with pyodbc.connect(CONNECTION_STRING) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT InvoiceNumber FROM Processed_Invoices")
-                processed = {row[0] for row in cursor.fetchall()}
-                logging.info(f"Found {len(processed)} previously processed invoices")
-                return processed
+            self._processed_invoices = self._query_processed_keys(SELECT_PROCESSED_INVOICES_SQL, since)
+            self._processed_since['invoices'] = since
+            logging.info(f"Found {len(self._processed_invoices)} previously processed invoices")
+            return self._processed_invoices
         except Exception as e:
             logging.error(f"Failed to fetch processed invoices: {str(e)}")
             return set()
 
-    def get_processed_receipts(self) -> set:
-        """Get set of already processed receipt voucher numbers"""
+    def get_processed_receipts(self, since: Optional[date]) -> set:
+        """Get set of already processed receipt voucher numbers with RevenueDate >= since (all if None)"""
+        if self._processed_receipts is not None and self._processed_covers('receipts', since):
+            return self._processed_receipts
+
         try:
-            with pyodbc.connect(CONNECTION_STRING) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT VoucherNumber FROM Processed_Receipts")
-                processed = {row[0] for row in cursor.fetchall()}
-                logging.info(f"Found {len(processed)} previously processed receipts")
-                return processed
+            self._processed_receipts = self._query_processed_keys(SELECT_PROCESSED_RECEIPTS_SQL, since)
+            self._processed_since['receipts'] = since
+            logging.info(f"Found {len(self._processed_receipts)} previously processed receipts")
+            return self._processed_receipts
         except Exception as e:
             logging.debug(f"Processed_Receipts table may not exist yet: {str(e)}")
             return set()
 
-    def get_processed_refunds(self) -> set:
-        """Get set of already processed refund voucher numbers"""
+    def get_processed_refunds(self, since: Optional[date]) -> set:
+        """Get set of already processed refund voucher numbers with RevenueDate >= since (all if None)"""
+        if self._processed_refunds is not None and self._processed_covers('refunds', since):
+            return self._processed_refunds
+
         try:
-            with pyodbc.connect(CONNECTION_STRING) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT VoucherNumber FROM Processed_Refunds")
-                processed = {row[0] for row in cursor.fetchall()}
-                logging.info(f"Found {len(processed)} previously processed refunds")
-                return processed
+            self._processed_refunds = self._query_processed_keys(SELECT_PROCESSED_REFUNDS_SQL, since)
+            self._processed_since['refunds'] = since
+            logging.info(f"Found {len(self._processed_refunds)} previously processed refunds")
+            return self._processed_refunds
         except Exception as e:
             logging.debug(f"Processed_Refunds table may not exist yet: {str(e)}")
             return set()
 
+    def _remember_committed(self, revenue_dates: List[date], invoices_by_date: Dict[date, List[Dict]],
+                            receipts_by_date: Dict[date, List[Dict]], refunds_by_date: Dict[date, List[Dict]]) -> None:
+        """Add the keys of committed revenue dates to the cached processed sets"""
+        for revenue_date in revenue_dates:
+            if self._processed_invoices is not None:
+                self._processed_invoices.update(
+                    inv.get('invoiceNumber') for inv in invoices_by_date.get(revenue_date, []))
+            if self._processed_receipts is not None:
+                self._processed_receipts.update(
+                    rec.get('voucherNumber') for rec in receipts_by_date.get(revenue_date, []))
+            if self._processed_refunds is not None:
+                self._processed_refunds.update(
+                    ref.get('voucherNumber') for ref in refunds_by_date.get(revenue_date, []))
+
     def _make_api_request(self, endpoint: str) -> Optional[List]:
         """Make API request with proper headers and error handling"""
         url = f"{BASE_URL}/{endpoint}"
-        headers = {
-            "Content-Type": "application/json",
-            "authKey": self.auth_key
-        }
 
         if isinstance(self.api_fetch_start, datetime):
             start_str = self.api_fetch_start.strftime('%Y-%m-%d %H:%M')
@@ -379,7 +642,7 @@ class NazeelComsysIntegrator:
 
         try:
             logging.info(f"Making API request to {endpoint}")
-            response = requests.post(url, json=payload, headers=headers, timeout=60)
+            response = self._session.post(url, json=payload, timeout=60)
             response.raise_for_status()
             data = response.json()
 
@@ -398,27 +661,27 @@ class NazeelComsysIntegrator:
         """Assign revenue date - uses transaction date as-is (no cutoff)"""
         return transaction_datetime.date()
 
-    def fetch_invoices(self) -> List[Dict]:
-        """Fetch invoices from API and filter out processed ones"""
-        data = self._make_api_request("Getinvoices")
+    def fetch_api_data(self) -> Dict[str, Optional[List]]:
+        """Request invoices, receipts and refunds from the API concurrently"""
+        endpoints = (INVOICES_ENDPOINT, RECEIPTS_ENDPOINT, REFUNDS_ENDPOINT)
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            return dict(zip(endpoints, executor.map(self._make_api_request, endpoints)))
+
+    def fetch_invoices(self, data: Optional[List]) -> List[Dict]:
+        """Filter fetched invoices and drop processed ones"""
         if data is None:
             return []
 
-        processed_invoices = self.get_processed_invoices()
-        valid_invoices = []
+        fetched_invoices = []
 
         for inv in data:
             if not isinstance(inv, dict) or inv.get('isReversed', False):
                 continue
 
-            invoice_number = inv.get('invoiceNumber')
-            if invoice_number in processed_invoices:
-                continue
-
             creation_date_str = inv.get('creationDate', '')
             if creation_date_str:
                 try:
-                    creation_datetime = datetime.fromisoformat(creation_date_str.replace('Z', ''))
+                    creation_datetime = _parse_api_datetime(creation_date_str)
                     if hasattr(self, 'current_run_time') and creation_datetime > self.current_run_time:
                         continue
 
@@ -431,32 +694,31 @@ class NazeelComsysIntegrator:
             else:
                 inv['_revenue_date'] = self.current_date
 
-            valid_invoices.append(inv)
+            fetched_invoices.append(inv)
+
+        valid_invoices = self._drop_processed(fetched_invoices, 'invoiceNumber', '_raw_creation_datetime',
+                                              self.get_processed_invoices)
+        valid_invoices = self._convert_amounts(valid_invoices, 'totalAmount', '_total_cents',
+                                               'invoice', 'invoiceNumber')
 
         logging.info(f"✓ Fetched {len(valid_invoices)} new invoices")
         return valid_invoices
 
-    def fetch_receipts(self) -> List[Dict]:
-        """Fetch receipt vouchers from API and filter out processed ones"""
-        data = self._make_api_request("GetReciptVouchers")
+    def fetch_receipts(self, data: Optional[List]) -> List[Dict]:
+        """Filter fetched receipt vouchers and drop processed ones"""
         if data is None:
             return []
 
-        processed_receipts = self.get_processed_receipts()
-        valid_receipts = []
+        fetched_receipts = []
 
         for rec in data:
             if not isinstance(rec, dict) or rec.get('isCanceled', False):
                 continue
 
-            voucher_number = rec.get('voucherNumber')
-            if voucher_number in processed_receipts:
-                continue
-
             issue_date_str = rec.get('issueDateTime', '')
             if issue_date_str:
                 try:
-                    issue_datetime = datetime.fromisoformat(issue_date_str.replace('Z', ''))
+                    issue_datetime = _parse_api_datetime(issue_date_str)
                     revenue_date = self.assign_revenue_date(issue_datetime)
                     rec['_raw_issue_datetime'] = issue_datetime
                     rec['_revenue_date'] = revenue_date
@@ -465,32 +727,31 @@ class NazeelComsysIntegrator:
             else:
                 rec['_revenue_date'] = self.current_date
 
-            valid_receipts.append(rec)
+            fetched_receipts.append(rec)
+
+        valid_receipts = self._drop_processed(fetched_receipts, 'voucherNumber', '_raw_issue_datetime',
+                                              self.get_processed_receipts)
+        valid_receipts = self._convert_amounts(valid_receipts, 'amount', '_amount_cents',
+                                               'receipt', 'voucherNumber')
 
         logging.info(f"✓ Fetched {len(valid_receipts)} new receipts")
         return valid_receipts
 
-    def fetch_refunds(self) -> List[Dict]:
-        """Fetch refund vouchers from API and filter out processed ones"""
-        data = self._make_api_request("GetRefundVouchers")
+    def fetch_refunds(self, data: Optional[List]) -> List[Dict]:
+        """Filter fetched refund vouchers and drop processed ones"""
         if data is None:
             return []
 
-        processed_refunds = self.get_processed_refunds()
-        valid_refunds = []
+        fetched_refunds = []
 
         for refund in data:
             if not isinstance(refund, dict) or refund.get('isCanceled', False):
                 continue
 
-            voucher_number = refund.get('voucherNumber')
-            if voucher_number in processed_refunds:
-                continue
-
             issue_date_str = refund.get('issueDateTime', '')
             if issue_date_str:
                 try:
-                    issue_datetime = datetime.fromisoformat(issue_date_str.replace('Z', ''))
+                    issue_datetime = _parse_api_datetime(issue_date_str)
                     revenue_date = self.assign_revenue_date(issue_datetime)
                     refund['_raw_issue_datetime'] = issue_datetime
                     refund['_revenue_date'] = revenue_date
@@ -499,51 +760,84 @@ class NazeelComsysIntegrator:
             else:
                 refund['_revenue_date'] = self.current_date
 
-            valid_refunds.append(refund)
+            fetched_refunds.append(refund)
+
+        valid_refunds = self._drop_processed(fetched_refunds, 'voucherNumber', '_raw_issue_datetime',
+                                             self.get_processed_refunds)
+        valid_refunds = self._convert_amounts(valid_refunds, 'amount', '_amount_cents',
+                                              'refund', 'voucherNumber', absolute=True)
 
         logging.info(f"✓ Fetched {len(valid_refunds)} new refunds")
         return valid_refunds
 
+    def _drop_processed(self, items: List[Dict], key_field: str, timestamp_key: str,
+                        get_processed: Callable[[Optional[date]], set]) -> List[Dict]:
+        """Drop fetched items whose key is already in the matching tracking table"""
+        if not items:
+            return []
+
+        # Bound the processed-key lookup by the revenue dates actually fetched: the
+        # API does not guarantee every record falls on or after the requested dateFrom
+        processed = get_processed(_processed_lookup_start(items, timestamp_key))
+        return [item for item in items if item.get(key_field) not in processed]
+
+    def _convert_amounts(self, items: List[Dict], amount_field: str, cents_key: str,
+                         item_type: str, key_field: str, absolute: bool = False) -> List[Dict]:
+        """Store each item's amount in halalas, holding back the revenue date of items with a bad amount"""
+        converted = []
+        for item in items:
+            amount = item.get(amount_field)
+            try:
+                cents = _to_cents(amount)
+            except (TypeError, ValueError, OverflowError):
+                logging.error(f"Invalid {amount_field} {amount!r} on {item_type} {item.get(key_field)}; "
+                              f"revenue date {item['_revenue_date']} will not be posted")
+                self._unpostable_dates.add(item['_revenue_date'])
+                if item_type != 'invoice' and item.get('reservationNumber'):
+                    self._unpostable_reservations.add(item['reservationNumber'])
+                continue
+
+            item[cents_key] = abs(cents) if absolute else cents
+            converted.append(item)
+        return converted
+
     def group_by_revenue_date(self, items: List[Dict], item_type: str) -> Dict[date, List[Dict]]:
         """Group items by revenue date"""
-        grouped = defaultdict(list)
+        grouped = {}
         for item in items:
             revenue_date = item.get('_revenue_date', self.current_date)
-            grouped[revenue_date].append(item)
+            grouped.setdefault(revenue_date, []).append(item)
 
         sorted_groups = dict(sorted(grouped.items()))
         logging.info(f"Grouped {len(items)} {item_type} into {len(sorted_groups)} date groups")
         return sorted_groups
 
-    def build_receipt_lookup(self, all_receipts: List[Dict]) -> Dict[str, List[Dict]]:
-        """Build lookup dictionary of receipts by reservation number"""
-        receipt_lookup = defaultdict(list)
-        for receipt in all_receipts:
-            reservation_num = receipt.get('reservationNumber')
-            if reservation_num:
-                receipt_lookup[reservation_num].append(receipt)
-        return receipt_lookup
-
-    def build_refund_lookup(self, all_refunds: List[Dict]) -> Dict[str, List[Dict]]:
-        """Build lookup dictionary of refunds by reservation number"""
-        refund_lookup = defaultdict(list)
-        for refund in all_refunds:
-            reservation_num = refund.get('reservationNumber')
+    def group_vouchers(self, items: List[Dict],
+                       item_type: str) -> Tuple[Dict[date, List[Dict]], Dict[str, Tuple[int, int]]]:
+        """Group receipts or refunds by revenue date and total them by reservation in one pass"""
+        grouped = {}
+        totals = {}
+        get_total = totals.get
+        for item in items:
+            grouped.setdefault(item.get('_revenue_date', self.current_date), []).append(item)
+
+            reservation_num = item.get('reservationNumber')
             if reservation_num:
-                refund_lookup[reservation_num].append(refund)
-        return refund_lookup
+                count, total = get_total(reservation_num, (0, 0))
+                totals[reservation_num] = (count + 1, total + item['_amount_cents'])
 
-    def match_invoice_to_receipts(self, invoice: Dict, receipt_lookup: Dict[str, List[Dict]],
-                                  refund_lookup: Dict[str, List[Dict]]) -> Tuple[str, float, float, float, float, str]:
-        """Match invoice to receipts and refunds, determine processing status"""
-        reservation_num = invoice.get('reservationNumber')
-        invoice_amount = float(invoice.get('totalAmount', 0))
+        sorted_groups = dict(sorted(grouped.items()))
+        logging.info(f"Grouped {len(items)} {item_type} into {len(sorted_groups)} date groups")
+        return sorted_groups, totals
 
-        receipts = receipt_lookup.get(reservation_num, [])
-        receipt_total = sum(float(r.get('amount', 0)) for r in receipts)
+    def match_invoice_to_receipts(self, invoice: Dict, receipt_totals: Dict[str, Tuple[int, int]],
+                                  refund_totals: Dict[str, Tuple[int, int]]) -> Tuple[str, int, int, int, int, str]:
+        """Match invoice to receipts and refunds, determine processing status (amounts in halalas)"""
+        reservation_num = invoice.get('reservationNumber')
+        invoice_amount = invoice['_total_cents']
 
-        refunds = refund_lookup.get(reservation_num, [])
-        refund_total = sum(abs(float(r.get('amount', 0))) for r in refunds)
+        _, receipt_total = receipt_totals.get(reservation_num, (0, 0))
+        refund_count, refund_total = refund_totals.get(reservation_num, (0, 0))
 
         net_received = receipt_total - refund_total
         difference = net_received - invoice_amount
@@ -551,22 +845,22 @@ class NazeelComsysIntegrator:
         if abs(difference) <= EXACT_MATCH_TOLERANCE:
             return ('PROCESS_EXACT', invoice_amount, receipt_total, refund_total, net_received, 'Exact match')
         elif difference > EXACT_MATCH_TOLERANCE:
-            if refunds:
+            if refund_count:
                 return ('PROCESS_OVERPAID_PARTIAL_REFUND', invoice_amount, receipt_total, refund_total, net_received,
-                        f'Overpaid by {difference:.2f} SAR (partial refund) → Cash O/S')
+                        f'Overpaid by {difference / 100:.2f} SAR (partial refund) → Cash O/S')
             else:
                 return ('PROCESS_OVERPAID_NO_REFUND', invoice_amount, receipt_total, refund_total, net_received,
-                        f'Overpaid by {difference:.2f} SAR (no refund) → Cash O/S')
+                        f'Overpaid by {difference / 100:.2f} SAR (no refund) → Cash O/S')
         elif abs(difference) <= UNDERPAYMENT_TOLERANCE:
             return ('PROCESS_UNDERPAID_SMALL', invoice_amount, receipt_total, refund_total, net_received,
-                    f'Short by {abs(difference):.2f} SAR → Cash O/S')
+                    f'Short by {abs(difference) / 100:.2f} SAR → Cash O/S')
         else:
             if net_received == 0:
                 return ('PROCESS_NO_NET_PAYMENT', invoice_amount, receipt_total, refund_total, net_received,
                         f'No net payment → Staff Account')
             else:
                 return ('PROCESS_UNDERPAID_LARGE', invoice_amount, receipt_total, refund_total, net_received,
-                        f'Short by {abs(difference):.2f} SAR → Staff Account')
+                        f'Short by {abs(difference) / 100:.2f} SAR → Staff Account')
 
     def extract_invoice_components(self, invoice: Dict) -> Dict[str, float]:
         """Extract revenue components from invoice"""
@@ -580,25 +874,22 @@ class NazeelComsysIntegrator:
         components['vat'] = float(invoice.get('vatAmount', 0))
 
         for item in invoice.get('invoicesItemsDetalis', []):
-            item_subtotal = float(item.get('subTotal', 0))
-            item_type = item.get('itemType')
-            item_type_str = item.get('type', '')
-
-            if item_type == 4 or item_type_str.startswith('Fee--'):
-                components['municipality_tax'] += item_subtotal
-            elif item_type == 3:
-                components['penalties'] += item_subtotal
-            elif item_type == 1:
-                components['individual_rate'] += item_subtotal
+            if item.get('type', '').startswith('Fee--'):
+                key = 'municipality_tax'
+            else:
+                key = _COMPONENT_BY_TYPE.get(item.get('itemType'))
+            if key:
+                components[key] += float(item.get('subTotal', 0))
 
         return components
 
-    def process_revenue_date(self, conn, revenue_date: date, date_receipts: List[Dict],
+    def process_revenue_date(self, cursor, revenue_date: date, date_receipts: List[Dict],
                              date_invoices: List[Dict], date_refunds: List[Dict],
-                             receipt_lookup: Dict[str, List[Dict]], refund_lookup: Dict[str, List[Dict]]) -> bool:
-        """Process all transactions for a single revenue date including refunds"""
+                             receipt_totals: Dict[str, Tuple[int, int]],
+                             refund_totals: Dict[str, Tuple[int, int]]) -> bool:
+        """Write all transactions for a single revenue date including refunds (caller commits)"""
         try:
-            logging.info(f"\n{'=' * 80}")
+            logging.info(f"\n{_BANNER}")
             logging.info(f"Processing Revenue Date: {revenue_date}")
             logging.info(
                 f"Receipts: {len(date_receipts)} | Refunds: {len(date_refunds)} | Invoices: {len(date_invoices)}")
@@ -606,79 +897,73 @@ class NazeelComsysIntegrator:
             processable_invoices = []
             cash_over_short_entries = []
             staff_account_entries = []
+            revenue_components = {
+                'individual_rate': 0.0,
+                'vat': 0.0,
+                'municipality_tax': 0.0,
+                'penalties': 0.0
+            }
 
+            match_invoice = self.match_invoice_to_receipts
+            extract_components = self.extract_invoice_components
+
+            # Match, classify and accumulate revenue components in one pass over the invoices
             for invoice in date_invoices:
-                status, invoice_amt, receipt_total, refund_total, net_received, reason = \
-                    self.match_invoice_to_receipts(invoice, receipt_lookup, refund_lookup)
+                status, invoice_cents, receipt_cents, refund_cents, net_cents, reason = \
+                    match_invoice(invoice, receipt_totals, refund_totals)
 
                 invoice['_match_status'] = status
                 invoice['_match_reason'] = reason
-                invoice['_receipt_amount'] = receipt_total
-                invoice['_refund_amount'] = refund_total
-                invoice['_net_received'] = net_received
+                invoice['_receipt_amount'] = receipt_cents / 100
+                invoice['_refund_amount'] = refund_cents / 100
+                invoice['_net_received'] = net_cents / 100
 
                 processable_invoices.append(invoice)
 
-                difference = net_received - invoice_amt
+                for key, value in extract_components(invoice).items():
+                    revenue_components[key] += value
+
+                difference = net_cents - invoice_cents
 
                 if abs(difference) > EXACT_MATCH_TOLERANCE:
+                    invoice_number = invoice.get('invoiceNumber')
+                    reservation = invoice.get('reservationNumber')
                     if difference > 0:
                         cash_over_short_entries.append({
-                            'invoice_number': invoice.get('invoiceNumber'),
-                            'reservation': invoice.get('reservationNumber'),
-                            'amount': difference,
+                            'invoice_number': invoice_number,
+                            'reservation': reservation,
+                            'amount': difference / 100,
                             'type': 'overpayment'
                         })
                     elif abs(difference) <= UNDERPAYMENT_TOLERANCE:
                         cash_over_short_entries.append({
-                            'invoice_number': invoice.get('invoiceNumber'),
-                            'reservation': invoice.get('reservationNumber'),
-                            'amount': difference,
+                            'invoice_number': invoice_number,
+                            'reservation': reservation,
+                            'amount': difference / 100,
                             'type': 'underpayment_small'
                         })
                     else:
                         staff_account_entries.append({
                             'invoice': invoice,
-                            'invoice_number': invoice.get('invoiceNumber'),
-                            'reservation': invoice.get('reservationNumber'),
+                            'invoice_number': invoice_number,
+                            'reservation': reservation,
                             'guest_name': invoice.get('customerName', ''),
-                            'invoice_amount': invoice_amt,
-                            'received_amount': receipt_total,
-                            'refunded_amount': refund_total,
-                            'net_received': net_received,
-                            'shortage': abs(difference),
-                            'type': 'NO_NET_PAYMENT' if net_received == 0 else 'UNDERPAID'
+                            'invoice_amount': invoice_cents / 100,
+                            'received_amount': receipt_cents / 100,
+                            'refunded_amount': refund_cents / 100,
+                            'net_received': net_cents / 100,
+                            'shortage': abs(difference) / 100,
+                            'type': 'NO_NET_PAYMENT' if net_cents == 0 else 'UNDERPAID'
                         })
 
             logging.info(f"All {len(processable_invoices)} invoices will be processed")
 
-            payment_methods = defaultdict(float)
-            for receipt in date_receipts:
-                method_id = receipt.get('paymentMethodId')
-                amount = float(receipt.get('amount', 0))
-                payment_methods[method_id] += amount
-
-            refund_methods = defaultdict(float)
-            for refund in date_refunds:
-                method_id = refund.get('paymentMethodId')
-                amount = abs(float(refund.get('amount', 0)))
-                refund_methods[method_id] += amount
+            payment_methods = _sum_by_payment_method(date_receipts)
+            refund_methods = _sum_by_payment_method(date_refunds)
 
             total_receipts = sum(payment_methods.values())
             total_refunds = sum(refund_methods.values())
 
-            revenue_components = {
-                'individual_rate': 0.0,
-                'vat': 0.0,
-                'municipality_tax': 0.0,
-                'penalties': 0.0
-            }
-
-            for invoice in processable_invoices:
-                components = self.extract_invoice_components(invoice)
-                for key in revenue_components:
-                    revenue_components[key] += components[key]
-
             total_revenue = sum(revenue_components.values())
             cash_over_short_total = sum(entry['amount'] for entry in cash_over_short_entries)
             staff_account_total = sum(entry['shortage'] for entry in staff_account_entries)
@@ -689,29 +974,24 @@ class NazeelComsysIntegrator:
             logging.info(
                 f"Cash O/S: {cash_over_short_total:.2f} | Staff: {staff_account_total:.2f} | Guest Ledger: {guest_ledger_amount:.2f}")
 
-            conn.autocommit = False
             try:
                 docu = self.generate_docu()
 
-                if not self._validate_journal(conn, docu):
+                if not self._validate_journal(cursor, docu):
                     raise ValueError(f"Invalid Docu {docu}")
 
-                year, month, serial = self.insert_fhgl_tx_hed(conn, docu, revenue_date)
-                self.insert_fhgl_tx_ded(conn, docu, year, month, serial, revenue_date,
+                year, month, serial = self.insert_fhgl_tx_hed(cursor, docu, revenue_date)
+                self.insert_fhgl_tx_ded(cursor, docu, year, month, serial, revenue_date,
                                         payment_methods, refund_methods, revenue_components,
                                         cash_over_short_total, staff_account_total, guest_ledger_amount)
 
-                self.insert_processed_receipts(conn, docu, year, month, serial, date_receipts)
-                self.insert_processed_refunds(conn, docu, year, month, serial, date_refunds)
-                self.insert_processed_invoices(conn, docu, year, month, serial, processable_invoices)
-                self.insert_staff_account_entries(conn, docu, year, month, serial, revenue_date, staff_account_entries)
-
-                conn.commit()
-                logging.info(f"✓ Successfully committed transaction")
+                self.insert_processed_receipts(cursor, docu, year, month, serial, date_receipts)
+                self.insert_processed_refunds(cursor, docu, year, month, serial, date_refunds)
+                self.insert_processed_invoices(cursor, docu, year, month, serial, processable_invoices)
+                self.insert_staff_account_entries(cursor, docu, year, month, serial, revenue_date, staff_account_entries)
                 return True
 
             except Exception as e:
-                conn.rollback()
                 logging.error(f"✗ Transaction failed: {str(e)}")
                 return False
 
@@ -723,41 +1003,22 @@ class NazeelComsysIntegrator:
         """Generate document number"""
         return "115"
 
-    def get_next_serial(self, conn, docu: str, year: str, month: str) -> int:
-        """Get the next available serial number"""
-        try:
-            cursor = conn.cursor()
-            cursor.execute(
-                f"SELECT ISNULL(MAX(Serial), 0) + 1 FROM {HED_TABLE} "
-                f"WHERE Docu = ? AND Year = ? AND Month = ?",
-                (docu, year, month)
-            )
-            return cursor.fetchone()[0]
-        except Exception as e:
-            logging.error(f"Error getting next serial: {str(e)}")
-            return 1
-
-    def insert_fhgl_tx_hed(self, conn, docu: str, revenue_date: date) -> Tuple[str, str, int]:
-        """Insert record into FhglTxHed table"""
-        cursor = conn.cursor()
+    def insert_fhgl_tx_hed(self, cursor, docu: str, revenue_date: date) -> Tuple[str, str, int]:
+        """Insert record into FhglTxHed table, allocating the next serial"""
         year = str(revenue_date.year)
         month = f"{revenue_date.month:02d}"
-        serial = self.get_next_serial(conn, docu, year, month)
         date_val = revenue_date.strftime('%Y-%m-%d')
 
-        sql = f"""
-        INSERT INTO {HED_TABLE} (Docu, Year, Month, Serial, Date, Currency, Rate, Posted, ReEvaluate, RepeatedSerial, Flag)
-        VALUES ('{docu}', '{year}', '{month}', {serial}, '{date_val}', '001', 1.0, 0, 0, NULL, NULL)
-        """
-        cursor.execute(sql)
+        cursor.execute(INSERT_HED_SQL, (docu, year, month, date_val, docu, year, month))
+        serial = cursor.fetchone()[0]
         return year, month, serial
 
-    def insert_fhgl_tx_ded(self, conn, docu: str, year: str, month: str, serial: int,
+    def insert_fhgl_tx_ded(self, cursor, docu: str, year: str, month: str, serial: int,
                            revenue_date: date, payment_methods: Dict[int, float],
                            refund_methods: Dict[int, float], revenue_components: Dict[str, float],
                            cash_over_short: float, staff_account: float, guest_ledger: float) -> None:
         """Insert records into FhglTxDed table with refunds support"""
-        cursor = conn.cursor()
+        rows = []
         line = 1
 
         payment_methods = {k: round(v, 2) for k, v in payment_methods.items()}
@@ -769,340 +1030,319 @@ class NazeelComsysIntegrator:
 
         # Debit: Payment Methods
         for method_id, amount in payment_methods.items():
-            if amount > 0 and method_id in PAYMENT_METHOD_ACCOUNTS:
-                account, description = PAYMENT_METHOD_ACCOUNTS[method_id]
-                self._insert_ded_line(
-                    cursor, docu, year, month, serial, line,
+            method_account = _payment_method_account(method_id)
+            if amount > 0 and method_account:
+                account, description = method_account
+                rows.append(self._ded_row(
+                    docu, year, month, serial, line,
                     account, amount, 0, amount, 0,
                     f"FOC Dep.: {description} for {revenue_date}"
-                )
+                ))
                 line += 1
 
         # Debit: Staff Account
         if staff_account > 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 STAFF_ACCOUNT, staff_account, 0, staff_account, 0,
                 f"FOC Dep.: Staff C/L for {revenue_date}"
-            )
+            ))
             line += 1
 
         # Debit: Guest Ledger (release prepayments)
         if guest_ledger < 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 GUEST_LEDGER_ACCOUNT, abs(guest_ledger), 0, abs(guest_ledger), 0,
                 f"FOC Dep.: Guest Ledger for {revenue_date}"
-            )
+            ))
             line += 1
 
         # Credit: Revenue Components
         if revenue_components['individual_rate'] > 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 REVENUE_ACCOUNT, 0, revenue_components['individual_rate'],
                 0, revenue_components['individual_rate'],
                 f"FOC Dep.: Individual Rate for {revenue_date}"
-            )
+            ))
             line += 1
 
         if revenue_components['vat'] > 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 VAT_ACCOUNT, 0, revenue_components['vat'],
                 0, revenue_components['vat'],
                 f"FOC Dep.: VAT for {revenue_date}"
-            )
+            ))
             line += 1
 
         if revenue_components['municipality_tax'] > 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 MUNICIPALITY_TAX_ACCOUNT, 0, revenue_components['municipality_tax'],
                 0, revenue_components['municipality_tax'],
                 f"FOC Dep.: Municipality Tax for {revenue_date}"
-            )
+            ))
             line += 1
 
         if revenue_components['penalties'] > 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 PENALTIES_ACCOUNT, 0, revenue_components['penalties'],
                 0, revenue_components['penalties'],
                 f"FOC Dep.: Penalties for {revenue_date}"
-            )
+            ))
             line += 1
 
         # Credit: Refund Methods
         for method_id, amount in refund_methods.items():
-            if amount > 0 and method_id in PAYMENT_METHOD_ACCOUNTS:
-                account, description = PAYMENT_METHOD_ACCOUNTS[method_id]
-                self._insert_ded_line(
-                    cursor, docu, year, month, serial, line,
+            method_account = _payment_method_account(method_id)
+            if amount > 0 and method_account:
+                account, description = method_account
+                rows.append(self._ded_row(
+                    docu, year, month, serial, line,
                     account, 0, amount, 0, amount,
                     f"FOC Dep.: Refund {description} for {revenue_date}"
-                )
+                ))
                 line += 1
 
         # Cash Over/Short
         if abs(cash_over_short) > 0:
             if cash_over_short > 0:
-                self._insert_ded_line(
-                    cursor, docu, year, month, serial, line,
+                rows.append(self._ded_row(
+                    docu, year, month, serial, line,
                     CASH_OVER_SHORT_ACCOUNT, 0, abs(cash_over_short),
                     0, abs(cash_over_short),
                     f"FOC Dep.: Cash O/S for {revenue_date}"
-                )
+                ))
             else:
-                self._insert_ded_line(
-                    cursor, docu, year, month, serial, line,
+                rows.append(self._ded_row(
+                    docu, year, month, serial, line,
                     CASH_OVER_SHORT_ACCOUNT, abs(cash_over_short), 0,
                     abs(cash_over_short), 0,
                     f"FOC Dep.: Cash O/S for {revenue_date}"
-                )
+                ))
             line += 1
 
         # Credit: Guest Ledger (prepayments)
         if guest_ledger > 0:
-            self._insert_ded_line(
-                cursor, docu, year, month, serial, line,
+            rows.append(self._ded_row(
+                docu, year, month, serial, line,
                 GUEST_LEDGER_ACCOUNT, 0, abs(guest_ledger),
                 0, abs(guest_ledger),
                 f"FOC Dep.: Guest Ledger for {revenue_date}"
-            )
+            ))
             line += 1
 
-    def _insert_ded_line(self, cursor, docu: str, year: str, month: str, serial: int,
-                         line: int, account: str, valu_le_dr: float, valu_le_cr: float,
-                         valu_fc_dr: float, valu_fc_cr: float, desc: str) -> None:
-        """Insert a single line into FhglTxDed table"""
-        desc_truncated = desc[:40] if len(desc) > 40 else desc.replace("'", "''")
-        sql = f"""
-        INSERT INTO {DED_TABLE} (Docu, Year, Month, Serial, Line, Account, ValuLeDr, ValuLeCr, ValuFcDr, ValuFcCr, [Desc])
-        VALUES ('{docu}', '{year}', '{month}', {serial}, {line}, '{account}', 
-                {valu_le_dr}, {valu_le_cr}, {valu_fc_dr}, {valu_fc_cr}, '{desc_truncated}')
-        """
-        cursor.execute(sql)
-
-    def insert_processed_receipts(self, conn, docu: str, year: str, month: str,
+        if not rows:
+            return
+
+        cursor.executemany(INSERT_DED_SQL, rows)
+
+    def _ded_row(self, docu: str, year: str, month: str, serial: int,
+                 line: int, account: str, valu_le_dr: float, valu_le_cr: float,
+                 valu_fc_dr: float, valu_fc_cr: float, desc: str) -> Tuple:
+        """Build the parameter tuple for a single FhglTxDed line"""
+        return (docu, year, month, serial, line, account,
+                valu_le_dr, valu_le_cr, valu_fc_dr, valu_fc_cr, desc[:40])
+
+    def insert_processed_receipts(self, cursor, docu: str, year: str, month: str,
                                   serial: int, receipts: List[Dict]) -> None:
         """Insert processed receipts into tracking table"""
         if not receipts:
             return
 
-        cursor = conn.cursor()
-
+        now = datetime.now().replace(microsecond=0)
+        today = date.today()
+        rows = []
         for receipt in receipts:
-            voucher_num = receipt.get('voucherNumber', '').replace("'", "''")
-            reservation_num = receipt.get('reservationNumber', '').replace("'", "''")
-            amount = float(receipt.get('amount', 0))
-            payment_method_id = receipt.get('paymentMethodId', 0)
+            voucher_num = receipt.get('voucherNumber', '')
             issue_datetime = receipt.get('_raw_issue_datetime')
-            revenue_date = receipt.get('_revenue_date')
 
-            issue_dt_str = issue_datetime.strftime('%Y-%m-%d %H:%M:%S') if issue_datetime else datetime.now().strftime(
-                '%Y-%m-%d %H:%M:%S')
-            revenue_date_str = revenue_date.strftime('%Y-%m-%d') if revenue_date else date.today().strftime('%Y-%m-%d')
+            rows.append((
+                voucher_num, receipt.get('reservationNumber', ''), _to_decimal(receipt.get('amount')),
+                receipt.get('paymentMethodId') or 0,
+                issue_datetime.replace(microsecond=0) if issue_datetime else now,
+                receipt.get('_revenue_date') or today,
+                docu, year, month, serial, voucher_num
+            ))
 
-            try:
-                sql = f"""
-                INSERT INTO Processed_Receipts 
-                (VoucherNumber, ReservationNumber, Amount, PaymentMethodId, IssueDateTime, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
-                VALUES ('{voucher_num}', '{reservation_num}', {amount}, {payment_method_id}, 
-                        '{issue_dt_str}', '{revenue_date_str}', '{docu}', '{year}', '{month}', {serial})
-                """
-                cursor.execute(sql)
-            except pyodbc.IntegrityError:
-                pass
-            except Exception as e:
-                logging.warning(f"Error inserting receipt {voucher_num}: {str(e)}")
+        _executemany_sized(cursor, INSERT_PROCESSED_RECEIPT_SQL, rows, PROCESSED_VOUCHER_INPUT_SIZES)
 
-    def insert_processed_refunds(self, conn, docu: str, year: str, month: str,
+    def insert_processed_refunds(self, cursor, docu: str, year: str, month: str,
                                  serial: int, refunds: List[Dict]) -> None:
         """Insert processed refunds into tracking table"""
         if not refunds:
             return
 
-        cursor = conn.cursor()
-
+        now = datetime.now().replace(microsecond=0)
+        today = date.today()
+        rows = []
         for refund in refunds:
-            voucher_num = refund.get('voucherNumber', '').replace("'", "''")
-            reservation_num = refund.get('reservationNumber', '').replace("'", "''")
-            amount = float(refund.get('amount', 0))
-            payment_method_id = refund.get('paymentMethodId', 0)
+            voucher_num = refund.get('voucherNumber', '')
             issue_datetime = refund.get('_raw_issue_datetime')
-            revenue_date = refund.get('_revenue_date')
 
-            issue_dt_str = issue_datetime.strftime('%Y-%m-%d %H:%M:%S') if issue_datetime else datetime.now().strftime(
-                '%Y-%m-%d %H:%M:%S')
-            revenue_date_str = revenue_date.strftime('%Y-%m-%d') if revenue_date else date.today().strftime('%Y-%m-%d')
+            rows.append((
+                voucher_num, refund.get('reservationNumber', ''), _to_decimal(refund.get('amount')),
+                refund.get('paymentMethodId') or 0,
+                issue_datetime.replace(microsecond=0) if issue_datetime else now,
+                refund.get('_revenue_date') or today,
+                docu, year, month, serial, voucher_num
+            ))
 
-            try:
-                sql = f"""
-                INSERT INTO Processed_Refunds 
-                (VoucherNumber, ReservationNumber, Amount, PaymentMethodId, IssueDateTime, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
-                VALUES ('{voucher_num}', '{reservation_num}', {amount}, {payment_method_id}, 
-                        '{issue_dt_str}', '{revenue_date_str}', '{docu}', '{year}', '{month}', {serial})
-                """
-                cursor.execute(sql)
-            except pyodbc.IntegrityError:
-                pass
-            except Exception as e:
-                logging.warning(f"Error inserting refund {voucher_num}: {str(e)}")
+        _executemany_sized(cursor, INSERT_PROCESSED_REFUND_SQL, rows, PROCESSED_VOUCHER_INPUT_SIZES)
 
-    def insert_processed_invoices(self, conn, docu: str, year: str, month: str,
+    def insert_processed_invoices(self, cursor, docu: str, year: str, month: str,
                                   serial: int, invoices: List[Dict]) -> None:
         """Insert processed invoices into tracking table"""
         if not invoices:
             return
 
-        cursor = conn.cursor()
-
+        today = date.today()
+        rows = []
         for invoice in invoices:
-            invoice_num = invoice.get('invoiceNumber', '').replace("'", "''")
-            reservation_num = invoice.get('reservationNumber', '').replace("'", "''")
-            total_amount = float(invoice.get('totalAmount', 0))
+            invoice_num = invoice.get('invoiceNumber', '')
             creation_datetime = invoice.get('_raw_creation_datetime')
-            revenue_date = invoice.get('_revenue_date')
 
-            creation_dt_str = creation_datetime.strftime('%Y-%m-%d %H:%M:%S') if creation_datetime else None
-            revenue_date_str = revenue_date.strftime('%Y-%m-%d') if revenue_date else date.today().strftime('%Y-%m-%d')
+            rows.append((
+                invoice_num, invoice.get('reservationNumber', ''), _to_decimal(invoice.get('totalAmount')),
+                invoice.get('_revenue_date') or today,
+                creation_datetime.replace(microsecond=0) if creation_datetime else None,
+                docu, year, month, serial, invoice_num
+            ))
 
-            try:
-                if creation_datetime:
-                    sql = f"""
-                    INSERT INTO Processed_Invoices 
-                    (InvoiceNumber, ReservationNumber, TotalAmount, RevenueDate, RawInvoiceDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
-                    VALUES ('{invoice_num}', '{reservation_num}', {total_amount}, '{revenue_date_str}', 
-                            '{creation_dt_str}', '{docu}', '{year}', '{month}', {serial})
-                    """
-                else:
-                    sql = f"""
-                    INSERT INTO Processed_Invoices 
-                    (InvoiceNumber, ReservationNumber, TotalAmount, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial)
-                    VALUES ('{invoice_num}', '{reservation_num}', {total_amount}, '{revenue_date_str}', 
-                            '{docu}', '{year}', '{month}', {serial})
-                    """
-                cursor.execute(sql)
-            except pyodbc.IntegrityError:
-                pass
-            except Exception as e:
-                logging.warning(f"Error inserting invoice {invoice_num}: {str(e)}")
+        _executemany_sized(cursor, INSERT_PROCESSED_INVOICE_SQL, rows, PROCESSED_INVOICE_INPUT_SIZES)
 
-    def insert_staff_account_entries(self, conn, docu: str, year: str, month: str,
+    def insert_staff_account_entries(self, cursor, docu: str, year: str, month: str,
                                      serial: int, revenue_date: date, staff_entries: List[Dict]) -> None:
         """Insert Staff Account entries into tracking table"""
         if not staff_entries:
             return
 
-        cursor = conn.cursor()
-
+        rows = []
         for entry in staff_entries:
-            invoice_num = entry['invoice_number'].replace("'", "''")
-            reservation_num = entry['reservation'].replace("'", "''")
-            guest_name = entry['guest_name'].replace("'", "''") if entry['guest_name'] else ''
-            invoice_amount = entry['invoice_amount']
             received_amount = entry.get('received_amount', 0)
             refunded_amount = entry.get('refunded_amount', 0)
             net_received = entry.get('net_received', received_amount - refunded_amount)
-            shortage = entry['shortage']
-            shortage_type = entry['type']
-
-            revenue_date_str = revenue_date.strftime('%Y-%m-%d')
 
             if refunded_amount > 0:
                 notes = f"Received: {received_amount:.2f}, Refunded: {refunded_amount:.2f}, Net: {net_received:.2f}"
-                notes_escaped = notes.replace("'", "''")
             else:
-                notes_escaped = None
+                notes = None
 
-            try:
-                if notes_escaped:
-                    sql = f"""
-                    INSERT INTO Staff_Account_Entries 
-                    (InvoiceNumber, ReservationNumber, GuestName, InvoiceAmount, ReceivedAmount, 
-                     ShortageAmount, ShortageType, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial, Status, Notes)
-                    VALUES ('{invoice_num}', '{reservation_num}', '{guest_name}', {invoice_amount}, 
-                            {net_received}, {shortage}, '{shortage_type}', '{revenue_date_str}', 
-                            '{docu}', '{year}', '{month}', {serial}, 'PENDING', '{notes_escaped}')
-                    """
-                else:
-                    sql = f"""
-                    INSERT INTO Staff_Account_Entries 
-                    (InvoiceNumber, ReservationNumber, GuestName, InvoiceAmount, ReceivedAmount, 
-                     ShortageAmount, ShortageType, RevenueDate, Docu, ComsysYear, ComsysMonth, ComsysSerial, Status)
-                    VALUES ('{invoice_num}', '{reservation_num}', '{guest_name}', {invoice_amount}, 
-                            {net_received}, {shortage}, '{shortage_type}', '{revenue_date_str}', 
-                            '{docu}', '{year}', '{month}', {serial}, 'PENDING')
-                    """
-                cursor.execute(sql)
-            except pyodbc.IntegrityError:
-                pass
-            except Exception as e:
-                logging.warning(f"Error inserting Staff Account entry {invoice_num}: {str(e)}")
+            rows.append((
+                entry['invoice_number'], entry['reservation'], entry['guest_name'] or '',
+                _to_decimal(entry['invoice_amount']), _to_decimal(net_received), _to_decimal(entry['shortage']),
+                entry['type'],
+                revenue_date, docu, year, month, serial, notes, entry['invoice_number']
+            ))
+
+        _executemany_sized(cursor, INSERT_STAFF_ACCOUNT_ENTRY_SQL, rows, STAFF_ACCOUNT_ENTRY_INPUT_SIZES)
 
     def process_all_data(self) -> bool:
         """Main processing function with Refund Vouchers support"""
         try:
-            logging.info(f"\n{'=' * 80}")
+            logging.info(f"\n{_BANNER}")
             logging.info(f"NAZEEL TO COMSYS INTEGRATION - v2.1 (NO TIME CUTOFF)")
-            logging.info(f"{'=' * 80}")
+            logging.info(_BANNER)
             logging.info(f"Script run time: {datetime.now()}")
 
-            all_invoices = self.fetch_invoices()
-            all_receipts = self.fetch_receipts()
-            all_refunds = self.fetch_refunds()
+            # Pop each raw payload so reversed, canceled and already processed
+            # records can be freed as soon as they have been filtered out
+            api_data = self.fetch_api_data()
+            all_invoices = self.fetch_invoices(api_data.pop(INVOICES_ENDPOINT))
+            all_receipts = self.fetch_receipts(api_data.pop(RECEIPTS_ENDPOINT))
+            all_refunds = self.fetch_refunds(api_data.pop(REFUNDS_ENDPOINT))
+
+            # A voucher dropped for a bad amount would skew its reservation's payment
+            # totals, so the dates of that reservation's invoices are held back too
+            self._unpostable_dates.update(inv['_revenue_date'] for inv in all_invoices
+                                          if inv.get('reservationNumber') in self._unpostable_reservations)
 
-            if not all_invoices and not all_receipts and not all_refunds:
+            if not all_invoices and not all_receipts and not all_refunds and not self._unpostable_dates:
                 logging.warning("No new data to process")
                 return False
 
             invoices_by_date = self.group_by_revenue_date(all_invoices, "invoices")
-            receipts_by_date = self.group_by_revenue_date(all_receipts, "receipts")
-            refunds_by_date = self.group_by_revenue_date(all_refunds, "refunds")
-
-            receipt_lookup = self.build_receipt_lookup(all_receipts)
-            refund_lookup = self.build_refund_lookup(all_refunds)
+            receipts_by_date, receipt_totals = self.group_vouchers(all_receipts, "receipts")
+            refunds_by_date, refund_totals = self.group_vouchers(all_refunds, "refunds")
 
-            all_dates = sorted(
-                set(list(invoices_by_date.keys()) + list(receipts_by_date.keys()) + list(refunds_by_date.keys())))
+            all_dates = sorted(invoices_by_date.keys() | receipts_by_date.keys() | refunds_by_date.keys() |
+                               self._unpostable_dates)
             logging.info(f"\n✓ Processing {len(all_dates)} revenue dates\n")
 
             success_count = 0
             failed_count = 0
 
-            with pyodbc.connect(CONNECTION_STRING) as conn:
-                for revenue_date in all_dates:
-                    date_receipts = receipts_by_date.get(revenue_date, [])
-                    date_invoices = invoices_by_date.get(revenue_date, [])
-                    date_refunds = refunds_by_date.get(revenue_date, [])
+            conn = self._get_conn()
+            cursor = conn.cursor()
+            cursor.fast_executemany = True
 
-                    success = self.process_revenue_date(
-                        conn, revenue_date, date_receipts, date_invoices, date_refunds,
-                        receipt_lookup, refund_lookup
-                    )
+            def write_revenue_date(revenue_date: date) -> bool:
+                return self.process_revenue_date(
+                    cursor, revenue_date, receipts_by_date.get(revenue_date, []),
+                    invoices_by_date.get(revenue_date, []), refunds_by_date.get(revenue_date, []),
+                    receipt_totals, refund_totals
+                )
 
-                    if success:
-                        success_count += 1
-                    else:
-                        failed_count += 1
+            pending_dates = []
+            pending_rows = 0
+
+            for revenue_date in all_dates:
+                if revenue_date in self._unpostable_dates:
+                    logging.error(f"Skipping revenue date {revenue_date}: it depends on records with invalid amounts")
+                    failed_count += 1
+                elif write_revenue_date(revenue_date):
+                    pending_dates.append(revenue_date)
+                    pending_rows += (len(receipts_by_date.get(revenue_date, [])) +
+                                     len(invoices_by_date.get(revenue_date, [])) +
+                                     len(refunds_by_date.get(revenue_date, [])))
+
+                    if len(pending_dates) >= COMMIT_BATCH_DATES or pending_rows >= COMMIT_BATCH_ROWS:
+                        conn.commit()
+                        self._remember_committed(pending_dates, invoices_by_date, receipts_by_date, refunds_by_date)
+                        logging.info(f"✓ Committed {len(pending_dates)} revenue dates")
+                        success_count += len(pending_dates)
+                        pending_dates = []
+                        pending_rows = 0
+                else:
+                    conn.rollback()
+                    failed_count += 1
+
+                    # The rollback also discarded the uncommitted dates of this batch,
+                    # so write them again one at a time
+                    for pending_date in pending_dates:
+                        if write_revenue_date(pending_date):
+                            conn.commit()
+                            self._remember_committed([pending_date], invoices_by_date, receipts_by_date, refunds_by_date)
+                            success_count += 1
+                        else:
+                            conn.rollback()
+                            failed_count += 1
+                    pending_dates = []
+                    pending_rows = 0
+
+            if pending_dates:
+                conn.commit()
+                self._remember_committed(pending_dates, invoices_by_date, receipts_by_date, refunds_by_date)
+                logging.info(f"✓ Committed {len(pending_dates)} revenue dates")
+                success_count += len(pending_dates)
 
-            logging.info(f"\n{'=' * 80}")
+            logging.info(f"\n{_BANNER}")
             logging.info(f"PROCESSING SUMMARY")
-            logging.info(f"{'=' * 80}")
+            logging.info(_BANNER)
             logging.info(f"Total revenue dates: {len(all_dates)}")
             logging.info(f"✓ Successfully processed: {success_count}")
             if failed_count > 0:
                 logging.info(f"✗ Failed: {failed_count}")
             logging.info(f"Invoices: {len(all_invoices)} | Receipts: {len(all_receipts)} | Refunds: {len(all_refunds)}")
-            logging.info(f"{'=' * 80}\n")
+            logging.info(f"{_BANNER}\n")
 
             return failed_count == 0
 
-        except Exception as e:
-            logging.error(f"✗ Processing failed: {str(e)}")
-            import traceback
-            logging.error(traceback.format_exc())
+        except Exception:
+            logging.exception("✗ Processing failed")
             return False
 
 
@@ -1113,38 +1353,36 @@ def main():
     parser = argparse.ArgumentParser(description='Nazeel to Comsys Integration v2.1')
     parser.add_argument('--start-date', type=str, help='Start date (YYYY-MM-DD HH:MM:SS)')
     parser.add_argument('--end-date', type=str, help='End date (YYYY-MM-DD HH:MM:SS)')
-    parser.add_argument('--days', type=int, help='Days to look back')
+    parser.add_argument('--days', type=int, help=f'Days to look back (default {DEFAULT_LOOKBACK_DAYS})')
+    parser.add_argument('--init-schema', action='store_true',
+                        help='Also add missing tracking-table columns and indexes before processing')
 
     args = parser.parse_args()
 
     try:
         if args.start_date and args.end_date:
-            start_date = datetime.strptime(args.start_date, '%Y-%m-%d %H:%M:%S')
-            end_date = datetime.strptime(args.end_date, '%Y-%m-%d %H:%M:%S')
-        elif args.days:
-            now = datetime.now()
-            end_date = now.replace(hour=12, minute=0, second=0, microsecond=0)
-            start_date = end_date - timedelta(days=args.days)
+            start_date = datetime.fromisoformat(args.start_date)
+            end_date = datetime.fromisoformat(args.end_date)
         else:
-            now = datetime.now()
-            end_date = now.replace(hour=12, minute=0, second=0, microsecond=0)
-            start_date = end_date - timedelta(days=120)
+            end_date = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+            start_date = end_date - timedelta(days=args.days or DEFAULT_LOOKBACK_DAYS)
 
-        integrator = NazeelComsysIntegrator(start_date, end_date)
-        success = integrator.process_all_data()
+        integrator = NazeelComsysIntegrator(start_date, end_date, init_schema=args.init_schema)
+        try:
+            success = integrator.process_all_data()
+        finally:
+            integrator.close()
 
         if success:
             logging.info("✓ Processing completed successfully")
-            exit(0)
+            sys.exit(0)
         else:
             logging.error("✗ Processing completed with errors")
-            exit(1)
+            sys.exit(1)
 
-    except Exception as e:
-        logging.error(f"✗ Fatal error: {str(e)}")
-        import traceback
-        logging.error(traceback.format_exc())
-        exit(1)
+    except Exception:
+        logging.exception("✗ Fatal error")
+        sys.exit(1)
 
 
 if __name__ == "__main__":